@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
+import array
 import asyncio
 import aiohttp
 import argparse
 import json
+import math
 import signal
 import sys
 import time
-from collections import Counter, deque
+from collections import deque
 from dataclasses import dataclass, asdict, field
 from typing import Optional, Dict, Any,List
+from yarl import URL
 import csv
 import click
+import numpy as np
 from prometheus_client import Counter as PromCounter, Histogram, start_http_server
 
 # Prometheus metrics
@@ -24,6 +28,15 @@ LATENCY = Histogram(
 
 # ------------ Metrics ------------
 
+# Log-linear latency histogram: ~3 significant digits from 0.01ms to 60s.
+# bucket(i) covers latencies where int(log(ms + 1) * HIST_SCALE) == i.
+HIST_SCALE = 512.0
+HIST_BUCKETS = int(math.log(60_000.0 + 1.0) * HIST_SCALE) + 2
+
+# Keep exact samples up to this many requests; small runs get exact
+# percentiles, longer ones fall back to the histogram.
+EXACT_SAMPLE_MAX = 100_000
+
 @dataclass
 class Metrics:
     start_time: float
@@ -31,70 +44,137 @@ class Metrics:
     total_requests: int = 0
     successful: int = 0
     failed: int = 0
-    status_counts: Dict[int, int] = field(default_factory=Counter)
-    latencies_ms: List[float] = field(default_factory=list)
+    status_counts: array.array = field(init=False, default=None)
+    latency_sum_ms: float = 0.0
+    min_latency_ms: float = math.inf
+    max_latency_ms: float = 0.0
     bytes_received: int = 0
     csv_path: Optional[str] = None
-    _csv_writer: Optional[csv.DictWriter] = field(init=False, default=None)
+    capacity: int = 0  # expected request count, sizes the sample array
+    _hist: array.array = field(init=False, default=None)
+    _csv_writer: Optional[object] = field(init=False, default=None)
     _csv_file: Optional[object] = field(init=False, default=None)
 
     def __post_init__(self):
-        if self.status_counts is None:
-            self.status_counts = Counter()
-        if self.latencies_ms is None:
-            self.latencies_ms = []
+        # Flat array indexed by status code; a C-level index beats
+        # Counter's dict machinery on the hot path
+        self.status_counts = array.array("Q", [0]) * 600
+        # Success lookup: 1 for 2xx/3xx, so record() replaces the range
+        # comparison with a table load
+        self._is_ok = array.array("b", [0]) * 600
+        for s in range(200, 400):
+            self._is_ok[s] = 1
+        self._hist = array.array("Q", [0]) * HIST_BUCKETS
+        # Preallocated sample array: 4 bytes/latency vs 28 for a PyFloat.
+        # Sized up front in fixed-request mode, doubled as needed otherwise.
+        cap = min(EXACT_SAMPLE_MAX, self.capacity) if self.capacity > 0 else 1024
+        self._lat = np.empty(cap, dtype=np.float32)
+        self._n = 0
+        # Workers enqueue samples; a single consumer task applies them,
+        # so the hot path never touches shared counters or the CSV writer.
+        self._q = asyncio.Queue(maxsize=4096)
         if self.csv_path:
-            self._csv_file = open(self.csv_path, "w", newline="", encoding="utf-8")
-            self._csv_writer = csv.DictWriter(
-                self._csv_file,
-                fieldnames=["timestamp", "status", "latency_ms", "bytes_received"]
-            )
-            self._csv_writer.writeheader()
+            # Large block buffer; rows are flushed on finalize (or periodically
+            # via --csv-flush-interval), not per row.
+            self._csv_file = open(self.csv_path, "w", newline="", encoding="utf-8", buffering=1 << 20)
+            # Plain csv.writer: queued samples are already tuples in
+            # column order, so rows go out with no per-row dict handling
+            self._csv_writer = csv.writer(self._csv_file)
+            self._csv_writer.writerow(("timestamp", "status", "latency_ms", "bytes_received"))
+
+    def enqueue(self, status: Optional[int], latency_ms: float, bytes_received: int):
+        try:
+            self._q.put_nowait((time.time(), status, latency_ms, bytes_received))
+        except asyncio.QueueFull:
+            # Rare: apply inline rather than drop the sample
+            self.record_batch([(time.time(), status, latency_ms, bytes_received)])
+
+    def record_batch(self, batch):
+        for _, status, latency_ms, bytes_received in batch:
+            self.record(status, latency_ms, bytes_received)
+        if self._csv_writer:
+            self._csv_writer.writerows(batch)
+
+    def drain(self):
+        batch = []
+        while not self._q.empty():
+            batch.append(self._q.get_nowait())
+        if batch:
+            self.record_batch(batch)
 
     def record(self, status: Optional[int], latency_ms: float, bytes_received: int):
         self.total_requests += 1
-        if status is not None and 200 <= status < 400:
-            self.successful += 1
-        else:
-            self.failed += 1
-        if status is not None:
+        if status is not None and 0 <= status < 600:
+            ok = self._is_ok[status]
             self.status_counts[status] += 1
-        self.latencies_ms.append(latency_ms)
+        else:
+            ok = 0
+        self.successful += ok
+        self.failed += 1 - ok
+        self.latency_sum_ms += latency_ms
+        if latency_ms < self.min_latency_ms:
+            self.min_latency_ms = latency_ms
+        if latency_ms > self.max_latency_ms:
+            self.max_latency_ms = latency_ms
+        bucket = int(math.log(latency_ms + 1.0) * HIST_SCALE)
+        if bucket < 0:
+            bucket = 0
+        elif bucket >= HIST_BUCKETS:
+            bucket = HIST_BUCKETS - 1
+        self._hist[bucket] += 1
+        if self._n < EXACT_SAMPLE_MAX:
+            if self._n == len(self._lat):
+                self._lat = np.resize(self._lat, min(EXACT_SAMPLE_MAX, 2 * len(self._lat)))
+            self._lat[self._n] = latency_ms
+            self._n += 1
         self.bytes_received += bytes_received
 
-        if self._csv_writer:
-            self._csv_writer.writerow({
-                "timestamp": time.time(),
-                "status": status,
-                "latency_ms": latency_ms,
-                "bytes_received": bytes_received
-            })
-            self._csv_file.flush()  # ensure data is written to disk
+    def flush_csv(self):
+        if self._csv_file:
+            self._csv_file.flush()
 
     def finalize(self):
         self.end_time = time.time()
         if self._csv_file:
+            self._csv_file.flush()
             self._csv_file.close()
 
     def summary(self) -> Dict[str, Any]:
         elapsed = max(1e-9, self.end_time - self.start_time)
-        lat = sorted(self.latencies_ms)
-        def pct(p):
-            if not lat:
-                return None
-            idx = int(max(0, min(len(lat)-1, round(p * (len(lat)-1)))))
-            return lat[idx]
+        n = self.total_requests
+        if n == 0:
+            mean = p50 = p95 = p99 = None
+        elif n <= EXACT_SAMPLE_MAX:
+            # Exact samples: one vectorized nearest-rank call for all three
+            arr = self._lat[:n]
+            p50, p95, p99 = (
+                float(v) for v in np.percentile(arr, [50, 95, 99], method="nearest")
+            )
+            mean = float(arr.mean(dtype=np.float64))
+        else:
+            def pct(p):
+                # Nearest-rank percentile via a cumulative walk of the histogram
+                rank = int(max(0, min(n - 1, round(p * (n - 1))))) + 1
+                cum = 0
+                for i, count in enumerate(self._hist):
+                    cum += count
+                    if cum >= rank:
+                        # Bucket midpoint, inverse of the log-linear mapping
+                        return math.exp((i + 0.5) / HIST_SCALE) - 1.0
+                return self.max_latency_ms
+            p50, p95, p99 = pct(0.5), pct(0.95), pct(0.99)
+            mean = self.latency_sum_ms / n
         return {
             "elapsed_seconds": elapsed,
             "total_requests": self.total_requests,
             "successful": self.successful,
             "failed": self.failed,
             "throughput_rps": self.total_requests / elapsed if elapsed > 0 else 0.0,
-            "mean_latency_ms": (sum(lat) / len(lat)) if lat else None,
-            "median_latency_ms": pct(0.5),
-            "p95_latency_ms": pct(0.95),
-            "p99_latency_ms": pct(0.99),
-            "status_counts": dict(self.status_counts),
+            "mean_latency_ms": mean,
+            "median_latency_ms": p50,
+            "p95_latency_ms": p95,
+            "p99_latency_ms": p99,
+            "status_counts": {s: c for s, c in enumerate(self.status_counts) if c},
             "bytes_received": self.bytes_received,
             "avg_bytes_per_response": (self.bytes_received / self.total_requests) if self.total_requests else 0,
         }
@@ -104,26 +184,23 @@ class Metrics:
 class TokenBucket:
     def __init__(self, rate_per_sec: float, burst: Optional[int] = None):
         self.rate = float(rate_per_sec)
-        self.capacity = int(burst if burst is not None else max(1, int(rate_per_sec)))
-        self.tokens = self.capacity
-        self.updated = time.monotonic()
-        self._lock = asyncio.Lock()
+        self.burst = int(burst if burst is not None else max(1, int(rate_per_sec)))
+        self.interval = 1.0 / self.rate if self.rate > 0 else 0.0
+        self.next_time = time.monotonic()
 
     async def acquire(self):
-        async with self._lock:
-            while self.tokens < 1:
-                now = time.monotonic()
-                delta = now - self.updated
-                # Refill tokens
-                refill = delta * self.rate
-                if refill >= 1:
-                    self.tokens = min(self.capacity, self.tokens + int(refill))
-                    self.updated = now
-                else:
-                    # Sleep until at least 1 token is available
-                    sleep_for = (1 - self.tokens) / self.rate if self.rate > 0 else 0.01
-                    await asyncio.sleep(max(0.001, sleep_for))
-            self.tokens -= 1
+        # Lock-free: the event loop is single-threaded, so advancing
+        # next_time without an await in between is atomic. Each caller
+        # claims the next slot and sleeps until it comes up.
+        now = time.monotonic()
+        # Let next_time lag now by at most `burst` intervals, then advance
+        # from the lagged deadline: up to `burst` slots fire immediately
+        # after idle, degrading to exact pacing when saturated
+        self.next_time = max(self.next_time, now - self.burst * self.interval)
+        t = self.next_time
+        self.next_time = t + self.interval
+        if t > now:
+            await asyncio.sleep(t - now)
 
 # ------------ Worker ------------
 
@@ -132,69 +209,91 @@ async def worker(name: int,
                  args,
                  metrics: Metrics,
                  bucket: Optional[TokenBucket],
-                 stop_at: Optional[float],
-                 remaining_counter: Optional[asyncio.Semaphore]):
+                 remaining: Optional[List[int]]):
+
+    # Hoist loop invariants: one ClientTimeout for the worker's lifetime and
+    # locals instead of repeated attribute lookups on every request
+    method = args.method
+    url = args.url
+    headers = args.headers
+    data = args.data
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    allow_redirects = args.allow_redirects
+    discard_body = args.discard_body
+    request = session.request
+    clock = time.monotonic_ns
+    enqueue = metrics.enqueue
+    acquire = bucket.acquire if bucket else None
+    # Prometheus: resolve the label children once; .labels() is a dict
+    # lookup behind a lock on every call
+    observe_latency = LATENCY.observe
+    requests_ok = REQUESTS_TOTAL.labels(status="success")
+    requests_err = REQUESTS_TOTAL.labels(status="error")
 
     while True:
-        # End conditions: duration or fixed requests
-        if stop_at is not None and time.time() >= stop_at:
-            return
-        if remaining_counter is not None:
-            try:
-                # Try to consume one request unit
-                await asyncio.wait_for(remaining_counter.acquire(), timeout=0.01)
-            except asyncio.TimeoutError:
+        # Duration mode ends via task cancellation (see run); only the
+        # fixed-request budget is checked here. Claim a unit before any
+        # await so no two workers can take the same one.
+        if remaining is not None:
+            if remaining[0] <= 0:
                 return
+            remaining[0] -= 1
         # Rate limit if needed
-        if bucket:
-            await bucket.acquire()
+        if acquire:
+            await acquire()
 
-        started = time.time()
+        started = clock()
         status = None
         bytes_rcv = 0
+        cancelled = False
         try:
-            async with session.request(
-                args.method,
-                args.url,
-                headers=args.headers,
-                data=args.data,
-                timeout=aiohttp.ClientTimeout(total=args.timeout),
-                allow_redirects=args.allow_redirects
+            async with request(
+                method,
+                url,
+                headers=headers,
+                data=data,
+                timeout=timeout,
+                allow_redirects=allow_redirects
             ) as resp:
                 status = resp.status
-                body = await resp.read()
-                bytes_rcv = len(body)
+                if discard_body:
+                    await resp.release()
+                else:
+                    # Count bytes chunk by chunk; never buffer the full body
+                    async for chunk in resp.content.iter_any():
+                        bytes_rcv += len(chunk)
         except asyncio.CancelledError:
+            # Duration deadline (or shutdown) hit mid-request: don't count
+            # the aborted request as a failure
+            cancelled = True
             raise
         except Exception:
             # Keep status None to count as failed
             pass
         finally:
-            latency_s = time.time() - started
-            latency_ms = (time.time() - started) * 1000.0
-            metrics.record(status, latency_ms, bytes_rcv)
-
-             # Prometheus updates
-            LATENCY.observe(latency_s)
-            if status is None:
-                REQUESTS_TOTAL.labels(status="error").inc()
-            elif status == 200:
-                REQUESTS_TOTAL.labels(status="success").inc()
-            else:
-                REQUESTS_TOTAL.labels(status="error").inc()
-                ERRORS_TOTAL.labels(error_type=str(status)).inc()
-
-
-        # If we were doing fixed-request mode and couldn't acquire a token, we should quit.
-        if remaining_counter is not None and remaining_counter._value <= 0:
-            # Let other workers observe depletion via acquire failure; we continue until semaphore says no.
-            pass
+            if not cancelled:
+                elapsed_ns = clock() - started
+                latency_s = elapsed_ns * 1e-9
+                latency_ms = elapsed_ns * 1e-6
+                enqueue(status, latency_ms, bytes_rcv)
+
+                # Prometheus updates
+                observe_latency(latency_s)
+                if status is None:
+                    requests_err.inc()
+                elif status == 200:
+                    requests_ok.inc()
+                else:
+                    requests_err.inc()
+                    ERRORS_TOTAL.labels(error_type=str(status)).inc()
 
 # ------------ Main ------------
 
 def parse_args():
     p = argparse.ArgumentParser(description="A simple async loadtester for a given URL.")
     p.add_argument("--csv", help="Write per-request details to CSV file.")
+    p.add_argument("--csv-flush-interval", type=float, default=0.0,
+                   help="Flush the CSV file every N seconds (0 = only at the end).")
     p.add_argument("url", help="Target URL.")
     p.add_argument("--prometheus", action="store_true", help="Expose Prometheus metrics on /metrics")
     p.add_argument("--metrics-port", type=int, default=8000, help="Port for Prometheus metrics server")
@@ -208,6 +307,7 @@ def parse_args():
     p.add_argument("--data", help="Inline payload string. Use @file.json to load from file.")
     p.add_argument("--no-verify", action="store_true", help="Disable TLS verification.")
     p.add_argument("--allow-redirects", action="store_true", help="Follow redirects.")
+    p.add_argument("--discard-body", action="store_true", help="Drop response bodies without counting bytes.")
     p.add_argument("--json-out", help="Write metrics summary to JSON file.")
     p.add_argument("--print_progress", action="store_true", help="Print progress every second.")
     return p.parse_args()
@@ -234,14 +334,34 @@ def load_data(arg):
 
 async def progress_task(metrics: Metrics):
     last = 0
+    write = sys.stdout.write
+    flush = sys.stdout.flush
     while True:
         await asyncio.sleep(1)
+        # total_requests is the only attribute sampled here; the consumer
+        # task owns all other metrics state
         current = metrics.total_requests
-        print(f"[progress] total={current} +{current - last}")
+        write(f"[progress] total={current} +{current - last}\n")
+        flush()
         last = current
 
+async def metrics_consumer(metrics: Metrics):
+    q = metrics._q
+    while True:
+        item = await q.get()
+        batch = [item]
+        # Drain whatever else is queued so CSV rows go out in one writerows
+        while not q.empty():
+            batch.append(q.get_nowait())
+        metrics.record_batch(batch)
+
+async def csv_flush_task(metrics: Metrics, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        metrics.flush_csv()
+
 async def run(args):
-    metrics = Metrics(start_time=time.time(), csv_path=args.csv)
+    metrics = Metrics(start_time=time.time(), csv_path=args.csv, capacity=args.requests)
 
     # Start Prometheus server only if flag is set
     if args.prometheus:
@@ -249,18 +369,46 @@ async def run(args):
         print(f"Prometheus metrics available at http://localhost:{args.metrics_port}/metrics")
 
     # Prepare rate limiter and termination conditions
-    bucket = TokenBucket(args.qps, burst=args.concurrency) if args.qps and args.qps > 0 else None
-    stop_at = time.time() + args.duration if args.duration and args.duration > 0 else None
-    remaining_counter = asyncio.Semaphore(args.requests) if (not stop_at and args.requests > 0) else None
-
-    # Build session
-    connector = aiohttp.TCPConnector(ssl=not args.no_verify, limit=0)
+    # Shard the rate limiter (~8 workers per shard) so workers don't all
+    # contend on one bucket; aggregate rate still equals args.qps
+    buckets = None
+    if args.qps and args.qps > 0:
+        shards = max(1, args.concurrency // 8)
+        buckets = [
+            TokenBucket(args.qps / shards, burst=max(1, args.concurrency // shards))
+            for _ in range(shards)
+        ]
+    duration_mode = bool(args.duration and args.duration > 0)
+    # Boxed int is enough on a single-threaded event loop; no Semaphore,
+    # no wait_for timer per request
+    remaining = [args.requests] if (not duration_mode and args.requests > 0) else None
+
+    # Build session; connector tuned for sustained high concurrency:
+    # no per-host cap, cached DNS, and long keepalive so connections
+    # are reused for the whole run
+    connector = aiohttp.TCPConnector(
+        ssl=not args.no_verify,
+        limit=0,
+        limit_per_host=0,
+        use_dns_cache=True,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        force_close=False,
+    )
     async with aiohttp.ClientSession(connector=connector) as session:
         # Progress printer
         progress = None
         if args.print_progress:
             progress = asyncio.create_task(progress_task(metrics))
 
+        # Single consumer applies queued samples off the workers' hot path
+        consumer = asyncio.create_task(metrics_consumer(metrics))
+
+        # Periodic CSV flusher for users who want live progress in the file
+        csv_flusher = None
+        if args.csv and args.csv_flush_interval > 0:
+            csv_flusher = asyncio.create_task(csv_flush_task(metrics, args.csv_flush_interval))
+
         # Graceful shutdown on CTRL+C
         shutdown_event = asyncio.Event()
         def _handle_sig():
@@ -276,21 +424,17 @@ async def run(args):
         workers = []
         for i in range(args.concurrency):
             workers.append(asyncio.create_task(worker(
-                i, session, args, metrics, bucket, stop_at, remaining_counter
+                i, session, args, metrics,
+                buckets[i % len(buckets)] if buckets else None,
+                remaining
             )))
 
-        # Stop conditions
-        if stop_at:
-            try:
-                await asyncio.wait(
-                    workers,
-                    timeout=max(0.0, stop_at - time.time())
-                )
-            except asyncio.CancelledError:
-                pass
-        else:
-            # Fixed request mode: wait until semaphore is exhausted and workers finish
-            await asyncio.gather(*workers, return_exceptions=True)
+        # Duration mode: a single timer cancels the workers at the deadline
+        # instead of every iteration polling the clock
+        if duration_mode:
+            loop.call_later(args.duration, lambda: [w.cancel() for w in workers])
+
+        await asyncio.gather(*workers, return_exceptions=True)
 
         # Early shutdown
         if shutdown_event.is_set():
@@ -301,6 +445,11 @@ async def run(args):
         # Ensure all workers are drained before finalizing
         await asyncio.gather(*workers, return_exceptions=True)
 
+        if csv_flusher:
+            csv_flusher.cancel()
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+        metrics.drain()
         metrics.finalize()
         if progress:
             progress.cancel()
@@ -350,6 +499,8 @@ def main():
     args = parse_args()
     args.headers = parse_headers(args.headers)
     args.data = load_data(args.data)
+    # Parse the URL once instead of per request
+    args.url = URL(args.url)
 
     if args.duration <= 0 and args.requests <= 0:
         print("Error: specify either --duration > 0 or --requests > 0", file=sys.stderr)
@@ -358,6 +509,13 @@ def main():
         print("Error: --concurrency must be >= 1", file=sys.stderr)
         sys.exit(1)
 
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        # Not installed or unsupported (e.g. Windows); stock asyncio is fine
+        pass
+
     try:
         asyncio.run(run(args))
     except KeyboardInterrupt: